@@ -1,74 +1,116 @@
 import asyncio
 import datetime
-import json
 import logging
 import os
-from itertools import chain
-from typing import Set, List
+import re
+from itertools import chain, count
+from typing import Dict, Set, List, Optional, Tuple
 
+import aiofiles
 import aiohttp
-from bs4 import BeautifulSoup
+import orjson
 
-from modules.utility import get_top_domains
+from modules.utility import UtilityFunctions, create_session
 
 logger = logging.getLogger(__name__)
 
+# The session-wide timeout is tuned for probing candidate IPs; the APIs below can be much slower,
+# so they keep aiohttp's default 5 minute budget
+SCRAPER_TIMEOUT = aiohttp.ClientTimeout(total=300)
+
+# Text of the first node in each DNSdumpster result cell (the hostname); the cell's class list may hold other classes
+DNSDUMPSTER_DOMAIN_PATTERN = re.compile(r'<td[^>]*\bclass="[^"]*\bcol-md-4\b[^"]*"[^>]*>\s*([^<]+)')
+
+
+def parse_dnsdumpster_domains(response_text: str) -> List[str]:
+    return [
+        found_domain.rstrip().split('HTTP')[0].strip('1234567890 .').rstrip('.')
+        for found_domain in DNSDUMPSTER_DOMAIN_PATTERN.findall(response_text)
+    ]
+
 class SubdomainGatherer:
-    def __init__(self, cache_dir: str = '../../cache'):
+    def __init__(self, cache_dir: str = '../../cache', max_concurrency: int = 20):
         self.cache_dir = os.path.normpath(os.path.dirname(os.path.join(os.path.realpath(__file__), cache_dir)))
+        self.session: Optional[aiohttp.ClientSession] = None
+        # DNSdumpster is the only source that needs cookies (CSRF token), so it gets its own small session
+        self.dnsdumpster_session: Optional[aiohttp.ClientSession] = None
+        # The CSRF token is session-scoped, so it is fetched once and reused for every domain
+        self._csrf_token: Optional[str] = None
+        self._csrf_lock = asyncio.Lock()
+        self.utility = UtilityFunctions()
+        # Bounds the number of in-flight API requests across all domains
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Cache file contents buffered in memory until flush_cache()
+        self._pending_writes: Dict[str, str] = {}
+        # One timestamp per run plus a sequence number keeps cache file names unique and cheap to build
+        self.run_timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self._seq = count()
         self.ensure_cache_dirs()
 
+    async def __aenter__(self):
+        self.session = create_session()
+        self.dnsdumpster_session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(), timeout=SCRAPER_TIMEOUT)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # Safety net for callers that never reach the end of gather_subdomains()
+        await self.flush_cache()
+        if self.session:
+            await self.session.close()
+        if self.dnsdumpster_session:
+            await self.dnsdumpster_session.close()
+
     def ensure_cache_dirs(self):
         for subdir in ['dnsdumpster_req_logs', 'certspotter_req_logs', 'hackertarget_req_logs', 'crtsh_req_logs']:
             os.makedirs(os.path.join(self.cache_dir, subdir), exist_ok=True)
 
-    async def dnsdumpster_scraping(self, domain: str) -> List[str]:
-        async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar()) as session:
-            async with session.get('https://dnsdumpster.com') as resp:
-                cookies = session.cookie_jar.filter_cookies('https://dnsdumpster.com')
-                csrf_token = str(cookies.get('csrftoken')).split('Set-Cookie: csrftoken=')[1]
+    async def _get_dnsdumpster_csrf(self) -> str:
+        async with self._csrf_lock:
+            if self._csrf_token is None:
+                async with self.dnsdumpster_session.get('https://dnsdumpster.com'):
+                    cookies = self.dnsdumpster_session.cookie_jar.filter_cookies('https://dnsdumpster.com')
+                    self._csrf_token = cookies['csrftoken'].value
+        return self._csrf_token
 
-            async with session.post(
+    async def dnsdumpster_scraping(self, domain: str) -> List[str]:
+        async with self.semaphore:
+            csrf_token = await self._get_dnsdumpster_csrf()
+            async with self.dnsdumpster_session.post(
                 'https://dnsdumpster.com',
                 data={'csrfmiddlewaretoken': csrf_token, 'targetip': domain, 'user': 'free'},
                 headers={
                     'Host': 'dnsdumpster.com',
                     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.98 Safari/537.36',
-                    'Referer': 'https://dnsdumpster.com/',
-                    'Cookie': f'csrftoken={csrf_token}'
+                    'Referer': 'https://dnsdumpster.com/'
                 }
             ) as resp:
                 response_text = await resp.text()
 
-        soup = BeautifulSoup(response_text, 'html.parser')
-        domains = [
-            found_domain.text.split('HTTP')[0].strip('1234567890 .').rstrip('.')
-            for found_domain in soup.find_all('td', {'class': 'col-md-4'})
-        ]
+        domains = parse_dnsdumpster_domains(response_text)
 
         self.write_to_cache('dnsdumpster_req_logs', domain, response_text, domains)
         return domains
 
     async def certspotter_scraping(self, domain: str) -> Set[str]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
+        async with self.semaphore:
+            async with self.session.get(
                 f'https://api.certspotter.com/v1/issuances?domain={domain}&expand=dns_names',
-                headers={'Accept': 'application/json'}
+                headers={'Accept': 'application/json'},
+                timeout=SCRAPER_TIMEOUT
             ) as resp:
-                response_json = await resp.json(encoding='utf-8')
+                response_json = orjson.loads(await resp.read())
 
-        domains = {
-            dns_name.lstrip('*.')
-            for item in response_json
-            for dns_name in item['dns_names']
-        }
+        # removeprefix() drops only a literal wildcard label, unlike lstrip('*.')
+        all_names = set(chain.from_iterable(item['dns_names'] for item in response_json))
+        domains = {dns_name.removeprefix('*.') for dns_name in all_names}
 
-        self.write_to_cache('certspotter_req_logs', domain, json.dumps(response_json, indent=2), domains)
+        self.write_to_cache('certspotter_req_logs', domain, orjson.dumps(response_json, option=orjson.OPT_INDENT_2).decode(), domains)
         return domains
 
     async def hackertarget_scraping(self, domain: str) -> Set[str]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'https://api.hackertarget.com/hostsearch/?q={domain}') as resp:
+        async with self.semaphore:
+            async with self.session.get(f'https://api.hackertarget.com/hostsearch/?q={domain}',
+                                        timeout=SCRAPER_TIMEOUT) as resp:
                 response_text = await resp.text(encoding='utf-8')
 
         if 'API count exceeded' in response_text:
@@ -80,72 +122,77 @@ class SubdomainGatherer:
         return domains
 
     async def crtsh_scraping(self, domain: str) -> Set[str]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
+        async with self.semaphore:
+            async with self.session.get(
                 f'https://crt.sh/?q={domain}&output=json',
-                headers={'Accept': 'application/json'}
+                headers={'Accept': 'application/json'},
+                timeout=SCRAPER_TIMEOUT
             ) as resp:
-                response_json = await resp.json(encoding='utf-8')
+                response_json = orjson.loads(await resp.read())
 
-        domains = {
-            name for item in response_json
-            for name in item['name_value'].split('\n')
-            if not name.startswith('*.')
-        }
+        # Deduplicate first, then filter wildcards on the (much smaller) unique set
+        all_names = set(chain.from_iterable(item['name_value'].splitlines() for item in response_json))
+        domains = {name for name in all_names if not name.startswith('*.')}
 
-        self.write_to_cache('crtsh_req_logs', domain, json.dumps(response_json, indent=2), domains)
+        self.write_to_cache('crtsh_req_logs', domain, orjson.dumps(response_json, option=orjson.OPT_INDENT_2).decode(), domains)
         return domains
 
     def write_to_cache(self, subdir: str, domain: str, response: str, domains: Set[str]):
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        prefix = f'{domain}_{self.run_timestamp}_{next(self._seq):05d}'
         cache_path = os.path.join(self.cache_dir, subdir)
 
-        with open(os.path.join(cache_path, f'{domain}_{timestamp}_response.txt'), 'w') as f:
-            f.write(response)
+        self._pending_writes[os.path.join(cache_path, f'{prefix}_response.txt')] = response
+        self._pending_writes[os.path.join(cache_path, f'{prefix}_domains.txt')] = '\n'.join(sorted(domains))
+
+    async def flush_cache(self):
+        pending, self._pending_writes = self._pending_writes, {}
+        for path, content in pending.items():
+            async with aiofiles.open(path, 'w') as f:
+                await f.write(content)
+
+    async def _scrape_one(self, domain: str) -> Tuple[str, Set[str]]:
+        tasks = [
+            self.dnsdumpster_scraping(domain),
+            self.certspotter_scraping(domain),
+            self.hackertarget_scraping(domain),
+            self.crtsh_scraping(domain)
+        ]
+
+        results = await asyncio.gather(*tasks)
+        subdomains = set(chain.from_iterable(results))
 
-        with open(os.path.join(cache_path, f'{domain}_{timestamp}_domains.txt'), 'w') as f:
-            f.write('\n'.join(sorted(domains)))
+        subdomains.update(self.utility.get_top_domains([domain]))
+        subdomains.add(domain)
+        return domain, subdomains
 
     async def gather_subdomains(self, domains: Set[str]) -> Set[str]:
+        if not self.session:
+            raise RuntimeError("Session not initialized. Use 'async with' to create an instance.")
         all_domains = set()
 
-        for domain in domains:
-            subdomains = set()
-            tasks = [
-                self.dnsdumpster_scraping(domain),
-                self.certspotter_scraping(domain),
-                self.hackertarget_scraping(domain),
-                self.crtsh_scraping(domain),
-                get_top_domains([domain])
-            ]
-
-            results = await asyncio.gather(*tasks)
-            for result in results:
-                subdomains.update(result)
-
-            subdomains.add(domain)
-            all_domains.update(subdomains)
-
-            self.write_subdomain_results(domain, subdomains)
+        # Scrape every domain concurrently; the semaphore keeps the request count bounded
+        tasks = [asyncio.create_task(self._scrape_one(domain)) for domain in domains]
+        for domain, subdomains in await asyncio.gather(*tasks):
+            all_domains |= subdomains
+            await self.write_subdomain_results(domain, sorted(subdomains))
 
-        self.write_all_domains(all_domains)
+        await self.write_all_domains(sorted(all_domains))
+        await self.flush_cache()
         return all_domains
 
-    def write_subdomain_results(self, domain: str, subdomains: Set[str]):
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f'{domain}_{timestamp}_subdomains.txt'
-        with open(os.path.join(self.cache_dir, filename), 'w') as f:
-            f.write('\n'.join(sorted(subdomains)))
+    async def write_subdomain_results(self, domain: str, sorted_subdomains: List[str]):
+        filename = f'{domain}_{self.run_timestamp}_{next(self._seq):05d}_subdomains.txt'
+        async with aiofiles.open(os.path.join(self.cache_dir, filename), 'wb') as f:
+            await f.write('\n'.join(sorted_subdomains).encode())
 
-    def write_all_domains(self, all_domains: Set[str]):
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f'ALL_DOMAINS_{timestamp}.txt'
-        with open(os.path.join(self.cache_dir, filename), 'w') as f:
-            f.write('\n'.join(sorted(all_domains)))
+    async def write_all_domains(self, sorted_domains: List[str]):
+        filename = f'ALL_DOMAINS_{self.run_timestamp}.txt'
+        async with aiofiles.open(os.path.join(self.cache_dir, filename), 'wb') as f:
+            await f.write('\n'.join(sorted_domains).encode())
 
 async def main(domains: Set[str]):
-    gatherer = SubdomainGatherer()
-    all_domains = await gatherer.gather_subdomains(domains)
+    async with SubdomainGatherer() as gatherer:
+        all_domains = await gatherer.gather_subdomains(domains)
     return sorted(all_domains)
 
 if __name__ == "__main__":
@@ -1,45 +1,153 @@
 import asyncio
+import codecs
+import difflib
 import ipaddress
 import logging
-from itertools import chain
+from bisect import bisect_right
+from concurrent.futures import Executor
+from io import StringIO
 from typing import List, Set, Tuple, Optional
 
+import aiofiles
 import aiohttp
+import lxml.html
 import tldextract
-from html_similarity import similarity
+from cachetools import LRUCache
+from html_similarity.structural_similarity import get_tags
+from html_similarity.style_similarity import get_classes, jaccard_similarity
 from pathlib import Path
 
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
 logger = logging.getLogger(__name__)
 
+# Candidate pages are truncated to this size; the similarity step never needs more
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+
+# Weight of the structural part in html_similarity.similarity (k), the rest is style similarity
+SIMILARITY_K = 0.3
+
+# (DOM tag sequence or None if unparsable, set of CSS classes)
+PageFeatures = Tuple[Optional[List[str]], Set[str]]
+
+
+def _page_encoding(charset: Optional[str]) -> str:
+    # Servers can declare any charset; fall back to UTF-8 for ones Python doesn't know
+    if charset:
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+def _page_features(content: str) -> PageFeatures:
+    try:
+        tags = get_tags(lxml.html.parse(StringIO(content)))
+    except Exception as e:
+        logger.debug(f'Structural parsing failed: {str(e)}')
+        tags = None
+    return tags, get_classes(content)
+
+
+def _similarity_score(original_features: PageFeatures, check_content: str) -> int:
+    # Same score as html_similarity.similarity(original, check, k=SIMILARITY_K), but the original
+    # page is parsed only once. Module-level so it can be pickled and run in a worker process.
+    # similarity() raises on documents without a root element (empty, whitespace or comment-only);
+    # those can't be compared, so they score 0 instead of matching any class-less page on style alone
+    original_tags, original_classes = original_features
+    check_tags, check_classes = _page_features(check_content)
+    if original_tags is None or check_tags is None:
+        return 0
+    structural = difflib.SequenceMatcher(None, original_tags, check_tags).ratio()
+    style = jaccard_similarity(original_classes, check_classes)
+    return int((SIMILARITY_K * structural + (1 - SIMILARITY_K) * style) * 100)
+
+
+def _create_resolver() -> aiohttp.abc.AbstractResolver:
+    # aiodns resolves hostnames concurrently instead of through the thread-pool getaddrinfo, but it is optional
+    # and only works on a SelectorEventLoop (the default loop on Windows is a ProactorEventLoop)
+    if aiodns is not None and isinstance(asyncio.get_running_loop(), asyncio.SelectorEventLoop):
+        return aiohttp.AsyncResolver()
+    return aiohttp.ThreadedResolver()
+
+
+def create_session() -> aiohttp.ClientSession:
+    # Explicit connector limits: aiohttp's default caps the whole pool at 100 connections
+    resolver = _create_resolver()
+    connector = aiohttp.TCPConnector(limit=500, limit_per_host=10, ttl_dns_cache=600, use_dns_cache=True,
+                                     enable_cleanup_closed=True, ssl=False, resolver=resolver)
+    # None of the shared requests need cookies; a real jar keeps expiry timers for every cookie it sees
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=3, sock_read=3),
+                                 cookie_jar=aiohttp.DummyCookieJar())
+
+
 class UtilityFunctions:
-    def __init__(self, cache_dir: str = '../../cache', data_dir: str = '../data'):
+    def __init__(self, cache_dir: str = '../../cache', data_dir: str = '../data',
+                 session: Optional[aiohttp.ClientSession] = None, executor: Optional[Executor] = None):
         self.cache_dir = Path(__file__).parent.parent.parent / cache_dir
         self.data_dir = Path(__file__).parent.parent / data_dir
-        self.session: Optional[aiohttp.ClientSession] = None
+        self.session = session
+        self._owns_session = False
+        # CPU-bound page comparison runs here; None falls back to the loop's default executor
+        self.executor = executor
+        self._tldextract: Optional[tldextract.TLDExtract] = None
+        # Fetched candidate pages keyed by URL, so an IP compared against several domains is downloaded once.
+        # Bounded by total characters rather than entry count
+        self._page_cache: LRUCache = LRUCache(maxsize=64 * MAX_PAGE_BYTES, getsizeof=len)
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        # Reuse a session shared by the caller (e.g. SubdomainGatherer) if one was provided
+        if not self.session:
+            self.session = create_session()
+            self._owns_session = True
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
+        if self.session and self._owns_session:
             await self.session.close()
+            self.session = None
+            self._owns_session = False
 
     async def get_page_content(self, url: str) -> Optional[str]:
         if not self.session:
             raise RuntimeError("Session not initialized. Use 'async with' to create an instance.")
         try:
-            async with self.session.get(f"https://{url}", ssl=False, timeout=3) as response:
-                return await response.text()
+            async with self.session.get(f"https://{url}") as response:
+                if (response.content_length or 0) > MAX_PAGE_BYTES:
+                    logger.info(f'Skipped | {url} page is too large: {response.content_length} bytes')
+                    return None
+                # Stream the body so a huge (or lying) response can't be fully buffered in memory
+                body = bytearray()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    body += chunk
+                    if len(body) >= MAX_PAGE_BYTES:
+                        del body[MAX_PAGE_BYTES:]
+                        break
+                return body.decode(_page_encoding(response.charset), errors='replace')
         except (aiohttp.ClientConnectorError, asyncio.TimeoutError) as e:
             logger.info(f'Skipped | Error with {url}: {str(e)}')
             return None
 
-    async def compare_two_pages(self, original_content: str, check_url: str) -> Tuple[str, int]:
-        check_content = await self.get_page_content(check_url)
+    async def get_page_features(self, content: str) -> PageFeatures:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _page_features, content)
+
+    async def compare_two_pages(self, original_features: PageFeatures, check_url: str) -> Tuple[str, int]:
+        check_content = self._page_cache.get(check_url)
+        if check_content is None:
+            # Only successful bodies are cached: a failure may be a transient timeout, so the IP is retried
+            # for the next domain
+            check_content = await self.get_page_content(check_url)
+            if check_content:
+                self._page_cache[check_url] = check_content
         if not check_content:
             return check_url, 0
-        similarity_score = int(similarity(original_content, check_content, k=0.3) * 100)
+        loop = asyncio.get_running_loop()
+        similarity_score = await loop.run_in_executor(self.executor, _similarity_score, original_features, check_content)
         return check_url, similarity_score
 
     async def parse_public_waf_ranges(self) -> List[str]:
@@ -50,16 +158,31 @@ class UtilityFunctions:
 
     async def filter_out_waf_ips(self, ips_to_check: Set[str]) -> Set[str]:
         waf_ips_with_cidr = await self.parse_public_waf_ranges()
-        all_waf_ips = set(chain.from_iterable(ipaddress.ip_network(waf_ip) for waf_ip in waf_ips_with_cidr))
-        return {ip for ip in ips_to_check if ipaddress.ip_address(ip) not in all_waf_ips}
+        # Keep the ranges as sorted (start, end) integers instead of expanding every host address;
+        # overlapping networks are merged so a single bisect answers each lookup
+        waf_networks = [ipaddress.ip_network(waf_ip, strict=False) for waf_ip in waf_ips_with_cidr if waf_ip]
+        waf_ranges = sorted(
+            (net.version, int(net.network_address), int(net.broadcast_address))
+            for version in (4, 6)
+            for net in ipaddress.collapse_addresses(n for n in waf_networks if n.version == version))
+        range_starts = [(version, start) for version, start, _ in waf_ranges]
+
+        def is_waf_ip(ip: str) -> bool:
+            address = ipaddress.ip_address(ip)
+            index = bisect_right(range_starts, (address.version, int(address))) - 1
+            return index >= 0 and waf_ranges[index][0] == address.version and int(address) <= waf_ranges[index][2]
 
-    async def get_top_domains(self, domains: List[str]) -> List[str]:
+        return {ip for ip in ips_to_check if not is_waf_ip(ip)}
+
+    def get_top_domains(self, domains: List[str]) -> List[str]:
         domains = list(filter(None, domains))
-        tld_cache = self.cache_dir / 'tldextract-cache'
-        custom_tldextract = tldextract.TLDExtract(cache_dir=str(tld_cache))
-        
+        # Build the extractor once; constructing it reloads the public suffix list from disk
+        if self._tldextract is None:
+            tld_cache = self.cache_dir / 'tldextract-cache'
+            self._tldextract = tldextract.TLDExtract(cache_dir=str(tld_cache))
+
         def extract_domain(domain: str) -> str:
-            extracted = custom_tldextract(domain)
+            extracted = self._tldextract(domain)
             return f"{extracted.domain}.{extracted.suffix}"
 
         return [extract_domain(domain) for domain in domains]
@@ -71,7 +194,8 @@ async def main():
         # Example usage
         content = await utils.get_page_content("example.com")
         if content:
-            comparison = await utils.compare_two_pages(content, "example.org")
+            features = await utils.get_page_features(content)
+            comparison = await utils.compare_two_pages(features, "example.org")
             print(f"Comparison result: {comparison}")
 
         ips_to_check = {"192.0.2.1", "198.51.100.1", "203.0.113.1"}
@@ -79,7 +203,7 @@ async def main():
         print(f"Filtered IPs: {filtered_ips}")
 
         domains = ["example.com", "sub.example.co.uk", "invalid..domain"]
-        top_domains = await utils.get_top_domains(domains)
+        top_domains = utils.get_top_domains(domains)
         print(f"Top domains: {top_domains}")
 
 if __name__ == "__main__":
@@ -0,0 +1,13 @@
+from modules.subdomain_gathering import parse_dnsdumpster_domains
+
+
+def test_parse_dnsdumpster_domains_matches_class_token():
+    response_text = '''
+        <td class="col-md-4">mail.example.com<br><span>HTTP: nginx</span></td>
+        <td class="col-md-4 text-left">www.example.com.
+        <br></td>
+        <td data-x="1" class="text-left col-md-4">api.example.com</td>
+        <td class="col-md-3">192.0.2.1</td>
+        <td class="col-md-44">not.a.result.example.com</td>
+    '''
+    assert parse_dnsdumpster_domains(response_text) == ['mail.example.com', 'www.example.com', 'api.example.com']
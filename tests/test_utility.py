@@ -0,0 +1,193 @@
+import asyncio
+import ipaddress
+import random
+from typing import List, Optional, Set
+
+import aiohttp
+import pytest
+from html_similarity import similarity
+
+from modules import utility
+from modules.utility import MAX_PAGE_BYTES, UtilityFunctions, _page_features, _similarity_score
+
+
+class FakeContent:
+    def __init__(self, chunks: List[bytes]):
+        self.chunks = chunks
+        self.chunks_read = 0
+
+    async def iter_chunked(self, n: int):
+        for chunk in self.chunks:
+            self.chunks_read += 1
+            yield chunk
+
+
+class FakeResponse:
+    def __init__(self, chunks: List[bytes], charset: Optional[str] = None, content_length: Optional[int] = None):
+        self.content = FakeContent(chunks)
+        self.charset = charset
+        self.content_length = content_length
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class FakeSession:
+    def __init__(self, response: FakeResponse):
+        self.response = response
+
+    def get(self, url: str):
+        return self.response
+
+
+def get_page_content(response: FakeResponse) -> Optional[str]:
+    utils = UtilityFunctions(session=FakeSession(response))
+    return asyncio.run(utils.get_page_content('192.0.2.1'))
+
+
+def test_get_page_content_unknown_charset_falls_back_to_utf8():
+    response = FakeResponse(['<p>héllo</p>'.encode('utf-8')], charset='foobar')
+    assert get_page_content(response) == '<p>héllo</p>'
+
+
+def test_get_page_content_uses_declared_charset():
+    response = FakeResponse(['<p>héllo</p>'.encode('latin-1')], charset='ISO-8859-1')
+    assert get_page_content(response) == '<p>héllo</p>'
+
+
+def test_get_page_content_skips_large_content_length():
+    response = FakeResponse([b'<p>never read</p>'], content_length=MAX_PAGE_BYTES + 1)
+    assert get_page_content(response) is None
+    assert response.content.chunks_read == 0
+
+
+def test_get_page_content_truncates_chunked_body():
+    chunk = b'a' * (MAX_PAGE_BYTES // 2 + 1)
+    response = FakeResponse([chunk, chunk, chunk])
+    content = get_page_content(response)
+    assert content == 'a' * MAX_PAGE_BYTES
+    assert response.content.chunks_read == 2
+
+
+async def create_resolver():
+    return utility._create_resolver()
+
+
+def test_create_resolver_uses_aiodns_on_selector_loop():
+    if utility.aiodns is None:
+        pytest.skip('aiodns is not installed')
+    loop = asyncio.SelectorEventLoop()
+    try:
+        assert isinstance(loop.run_until_complete(create_resolver()), aiohttp.AsyncResolver)
+    finally:
+        loop.close()
+
+
+def test_create_resolver_falls_back_without_aiodns(monkeypatch):
+    monkeypatch.setattr(utility, 'aiodns', None)
+    assert isinstance(asyncio.run(create_resolver()), aiohttp.ThreadedResolver)
+
+
+def test_create_resolver_falls_back_on_non_selector_loop(monkeypatch):
+    monkeypatch.setattr(utility, 'aiodns', object())
+    monkeypatch.setattr(utility.asyncio, 'SelectorEventLoop', type('ProactorOnlyLoop', (), {}))
+    assert isinstance(asyncio.run(create_resolver()), aiohttp.ThreadedResolver)
+
+
+def test_compare_two_pages_caches_only_successful_fetches():
+    pages = iter([None, '<p class="a">x</p>'])
+    fetched = []
+
+    async def fake_get_page_content(url: str) -> Optional[str]:
+        fetched.append(url)
+        return next(pages)
+
+    async def compare_three_times(utils: UtilityFunctions):
+        features = await utils.get_page_features('<p class="a">x</p>')
+        return [await utils.compare_two_pages(features, '192.0.2.1') for _ in range(3)]
+
+    utils = UtilityFunctions()
+    utils.get_page_content = fake_get_page_content
+    results = asyncio.run(compare_three_times(utils))
+    assert results == [('192.0.2.1', 0), ('192.0.2.1', 100), ('192.0.2.1', 100)]
+    # The failed fetch is retried, the successful one is served from the cache
+    assert fetched == ['192.0.2.1', '192.0.2.1']
+
+
+SIMILARITY_DOCUMENTS = [
+    '<html><body><div class="a b"><p class="c">x</p><!-- comment --></div></body></html>',
+    '<html><body><div class="a"><span class="d">x</span></div><p>y</p></body></html>',
+    '<html><head><title>t</title></head><body><p>no classes</p></body></html>',
+    '<div><ul><li>one</li><li>two</li></ul></div>',
+    '<p class="c"><!-- only a comment inside --></p>',
+]
+
+
+@pytest.mark.parametrize('original', SIMILARITY_DOCUMENTS)
+@pytest.mark.parametrize('check', SIMILARITY_DOCUMENTS)
+def test_similarity_score_matches_html_similarity(original, check):
+    assert _similarity_score(_page_features(original), check) == int(similarity(original, check, k=0.3) * 100)
+
+
+@pytest.mark.parametrize('unparsable', ['', '   ', '<!-- only a comment -->'])
+def test_similarity_score_is_zero_for_unparsable_pages(unparsable):
+    classless = '<html><body><p>no classes</p></body></html>'
+    # html_similarity itself raises on documents without a root element
+    with pytest.raises(AttributeError):
+        similarity(unparsable, classless, k=0.3)
+    assert _page_features(unparsable)[0] is None
+    assert _similarity_score(_page_features(unparsable), classless) == 0
+    assert _similarity_score(_page_features(classless), unparsable) == 0
+
+
+WAF_RANGES = [
+    '104.16.0.0/13',
+    '104.24.0.0/14',      # adjacent to the range above
+    '104.16.5.0/24',      # nested inside the first range
+    '10.0.0.0/9',
+    '10.64.0.0/10',       # overlaps the end of 10.0.0.0/9
+    '10.128.0.0/16',      # adjacent to the end of 10.0.0.0/9
+    '192.0.2.7/32',
+    '198.51.100.17/24',   # host bits set, parsed non-strictly
+    '2400:cb00::/32',
+    '2606:4700::/44',
+    '2606:4700:10::/48',  # adjacent to the range above
+    '',
+]
+
+
+def filter_out_waf_ips(ips: Set[str]) -> Set[str]:
+    utils = UtilityFunctions()
+
+    async def parse_public_waf_ranges() -> List[str]:
+        return WAF_RANGES
+
+    utils.parse_public_waf_ranges = parse_public_waf_ranges
+    return asyncio.run(utils.filter_out_waf_ips(ips))
+
+
+def test_filter_out_waf_ips_matches_brute_force():
+    networks = [ipaddress.ip_network(waf_ip, strict=False) for waf_ip in WAF_RANGES if waf_ip]
+    rng = random.Random(1337)
+    ips = {str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(20000)}
+    # Bias the random sample towards the ranges, and include every first/last address and its neighbours
+    for net in networks:
+        first, last = int(net.network_address), int(net.broadcast_address)
+        max_address = 2 ** net.max_prefixlen - 1
+        candidates = [first - 1, first, first + 1, last - 1, last, last + 1]
+        candidates += [rng.randint(first, last) for _ in range(200)]
+        ips.update(str(ipaddress.ip_address(address)) for address in candidates if 0 <= address <= max_address)
+    # IPv6 addresses whose integer value falls inside an IPv4 range must not be filtered
+    ips.update(str(ipaddress.IPv6Address(int(ipaddress.IPv4Address(ip)))) for ip in ['104.16.0.1', '10.1.2.3'])
+    ips.update(['0.0.0.0', '255.255.255.255', '::', 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff'])
+
+    expected = {
+        ip for ip in ips
+        if not any(ipaddress.ip_address(ip) in net for net in networks)
+    }
+    assert filter_out_waf_ips(ips) == expected
+    assert '104.23.255.255' not in expected and '104.28.0.0' in expected
+    assert '10.127.255.255' not in expected and '10.129.0.0' in expected
@@ -2,23 +2,32 @@
 import argparse
 import asyncio
 import datetime
+import hashlib
 import logging
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Set
+from typing import Set, Tuple
 
+import aiofiles
 from colorama import Fore, init as colorama_init
 
 from modules.ip_gathering import ip_gathering
-from modules.subdomain_gathering import subdomain_gathering
-from modules.utility import UtilityFunctions
+from modules.subdomain_gathering import SubdomainGatherer
+from modules.utility import PageFeatures, UtilityFunctions
 
 class WAFAbuser:
+    # Maximum number of candidate IPs fetched at the same time
+    COMPARE_CONCURRENCY = 50
+
     def __init__(self):
         self.logger = self._create_logger()
         self.args = self._parse_arguments()
-        self.utility = UtilityFunctions()
+        self._pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+        self.utility = UtilityFunctions(executor=self._pool)
+        # (page content hash, IP) pairs that were already compared
+        self._seen: Set[Tuple[bytes, str]] = set()
 
     @staticmethod
     def _create_logger() -> logging.Logger:
@@ -61,9 +70,9 @@ class WAFAbuser:
             return {line.strip() for line in self.args.file_domains}
         return {self.args.input_domain}
 
-    async def find_subdomains(self, input_domains: Set[str]) -> Set[str]:
+    async def find_subdomains(self, gatherer: SubdomainGatherer, input_domains: Set[str]) -> Set[str]:
         self.logger.info("1. Gathering subdomains")
-        subdomains = await subdomain_gathering(input_domains)
+        subdomains = await gatherer.gather_subdomains(input_domains)
         self.logger.debug(f"Found subdomains: {subdomains}")
         return subdomains
 
@@ -82,18 +91,30 @@ class WAFAbuser:
     async def compare_ips(self, input_domains: Set[str], filtered_ips: Set[str]) -> Set[tuple]:
         self.logger.info("4. Comparing found IPs with original domain")
         similarity_output = set()
+        semaphore = asyncio.Semaphore(self.COMPARE_CONCURRENCY)
+
+        async def bounded_compare(util: UtilityFunctions, domain_features: PageFeatures, ip: str) -> tuple:
+            async with semaphore:
+                return await util.compare_two_pages(domain_features, ip)
+
         async with self.utility as util:
             for domain in input_domains:
                 domain_content = await util.get_page_content(domain)
                 if domain_content is None:
                     continue
-                for ip in filtered_ips:
-                    result = await util.compare_two_pages(domain_content, ip)
-                    if result[1] > self.args.similarity_rate:
-                        similarity_output.add(result)
+                # Domains serving identical pages would produce identical scores
+                content_hash = hashlib.blake2b(domain_content.encode(), digest_size=16).digest()
+                ips_to_compare = [ip for ip in filtered_ips if (content_hash, ip) not in self._seen]
+                self._seen.update((content_hash, ip) for ip in ips_to_compare)
+                if not ips_to_compare:
+                    continue
+                # Parse the original page once and reuse it for every candidate IP
+                domain_features = await util.get_page_features(domain_content)
+                results = await asyncio.gather(*(bounded_compare(util, domain_features, ip) for ip in ips_to_compare))
+                similarity_output.update(result for result in results if result[1] > self.args.similarity_rate)
         return similarity_output
 
-    def output_results(self, similarity_output: Set[tuple]):
+    async def output_results(self, similarity_output: Set[tuple]):
         if not similarity_output:
             self.logger.warning(f"5. Found 0 pages with similarity > {self.args.similarity_rate}%")
             self.logger.info("You can reduce the similarity percentage [--similarity_rate 70]")
@@ -101,43 +122,54 @@ class WAFAbuser:
 
         self.logger.info(f"5. {Fore.GREEN}Found possible IPs:{Fore.RESET}")
         row_format = "{:>15}" * 2
-        print(row_format.format("IP", "Similarity"))
-        for ip, similarity in similarity_output:
-            print(row_format.format(ip, f"{similarity}%"))
+        # Format every row once, highest similarity first, and reuse it for the console and the file
+        lines = "\n".join(row_format.format(ip, f"{similarity}%")
+                          for ip, similarity in sorted(similarity_output, key=lambda row: (-row[1], row[0])))
+        sys.stdout.write(f'{row_format.format("IP", "Similarity")}\n{lines}\n')
 
         output_dir = Path(__file__).parent.parent / 'output'
         output_dir.mkdir(exist_ok=True)
         output_file = output_dir / f'possible_WAF_bypass_{datetime.datetime.now():%Y%m%d_%H%M%S}.txt'
-        with output_file.open('w') as f:
-            f.write("\n".join(row_format.format(ip, f"{similarity}%") for ip, similarity in similarity_output))
+        async with aiofiles.open(output_file, 'w') as f:
+            await f.write(lines)
+
+    def shutdown(self):
+        self._pool.shutdown(cancel_futures=True)
 
     async def run(self):
         colorama_init()
         self.print_banner()
 
         input_domains = self.get_input_domains()
-        subdomains = await self.find_subdomains(input_domains)
 
-        if self.args.domains_only:
-            self.logger.info(f"{Fore.GREEN}Found {len(subdomains)} domains/subdomains:{Fore.RESET}")
-            for domain in subdomains:
-                print(domain)
-            self.logger.info(f"File output: {Path(__file__).parent.parent / 'cache'}")
-            return
+        # One session (and connection pool) for the whole pipeline
+        async with SubdomainGatherer() as gatherer:
+            self.utility.session = gatherer.session
+            subdomains = await self.find_subdomains(gatherer, input_domains)
 
-        ips = await self.find_ips(subdomains)
-        filtered_ips = await self.filter_ips(ips)
+            if self.args.domains_only:
+                self.logger.info(f"{Fore.GREEN}Found {len(subdomains)} domains/subdomains:{Fore.RESET}")
+                for domain in subdomains:
+                    print(domain)
+                self.logger.info(f"File output: {Path(__file__).parent.parent / 'cache'}")
+                return
 
-        if not filtered_ips:
-            self.logger.info(f"{Fore.GREEN}Found 0 possible non-WAF IPs{Fore.RESET}")
-            return
+            ips = await self.find_ips(subdomains)
+            filtered_ips = await self.filter_ips(ips)
 
-        similarity_output = await self.compare_ips(input_domains, filtered_ips)
-        self.output_results(similarity_output)
+            if not filtered_ips:
+                self.logger.info(f"{Fore.GREEN}Found 0 possible non-WAF IPs{Fore.RESET}")
+                return
+
+            similarity_output = await self.compare_ips(input_domains, filtered_ips)
+        await self.output_results(similarity_output)
 
 async def main():
     waf_abuser = WAFAbuser()
-    await waf_abuser.run()
+    try:
+        await waf_abuser.run()
+    finally:
+        waf_abuser.shutdown()
 
 if __name__ == '__main__':
     try: